@@ -2,18 +2,76 @@
 # Main application file to run the Chain-of-Verification (CoVe) and other guardrails.
 
 import asyncio
+import copy
+import functools
+import hashlib
+import httpx
+import nemoguardrails
 from nemoguardrails import RailsConfig, LLMRails
+from nemoguardrails.actions.llm.utils import LLMCallException
+import ollama
+import openai
 import os
+import pickle
+import pydantic
+import sys
+import threading
 import yaml
 from importlib import import_module
 
+# Use libyaml's C parser when PyYAML was built with it; fall back to the pure-Python one.
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 # --- Configuration ---
 # You can switch between 'ollama' and 'openai' here.
 LLM_PROVIDER = "ollama" 
 
+# Print the bot's response token by token as it is generated. Sessions with output rails
+# (e.g. CoVe) always wait for the full response, since those rails rewrite or block it.
+STREAMING = True
+
 # --- Guardrails Configuration ---
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "cove_guardrails")
 
+# The base config.yml is read once at import and treated as read-only; sessions merge
+# their guardrails on top of it with deep_merge_cow.
+with open(os.path.join(CONFIG_PATH, "config.yml"), 'r') as f:
+    _BASE_CONFIG = yaml.load(f, Loader=SafeLoader)
+
+# --- Config Cache ---
+# Parsed RailsConfig objects are pickled here, keyed by a hash of their inputs,
+# so that relaunching with the same guardrail selection skips Colang/YAML parsing.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nemo_veritas")
+
+# --- HTTP Client ---
+# A single pooled client is shared by all LLM calls of a session, so the 2+N calls per
+# CoVe turn reuse open connections instead of reconnecting. The timeout matches the
+# OpenAI SDK default, since LLM calls routinely take longer than httpx's 5s default.
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+# Longest time (in seconds) the first chat turn waits for the warmup call to finish before
+# cancelling it and going ahead.
+WARMUP_WAIT = 10
+
+# Errors raised by a single chat turn (LLM provider, transport and guardrail failures) that
+# are reported to the user without ending the session. Anything else propagates.
+# nemoguardrails wraps provider failures in LLMCallException; OSError covers the builtin
+# ConnectionError raised when a local Ollama server is down.
+TURN_ERRORS = (
+    LLMCallException,
+    RuntimeError,
+    ValueError,
+    OSError,
+    asyncio.TimeoutError,
+    httpx.HTTPError,
+    openai.OpenAIError,
+    ollama.ResponseError,
+)
+
 # --- Guardrails Library ---
 # This dictionary defines the available guardrails that can be activated.
 # Each entry contains:
@@ -91,22 +149,195 @@ GUARDRAILS_LIBRARY = {
     }
 }
 
-def deep_merge(source, destination):
+# Valid menu choices, for validating user input.
+_VALID_CHOICES = frozenset(GUARDRAILS_LIBRARY)
+
+def _hashable(item):
+    """
+    Returns a hashable key for a config value, so lists of dicts can be deduplicated and
+    whole configs can serve as cache keys.
+    Dict entries are ordered by repr(key), since YAML allows keys of mixed, unorderable types.
+    Containers are tagged with their type, so a dict and a list of pairs never share a key.
+    """
+    if isinstance(item, dict):
+        entries = sorted(item.items(), key=lambda entry: repr(entry[0]))
+        return ("dict", tuple((key, _hashable(value)) for key, value in entries))
+    if isinstance(item, list):
+        return ("list", tuple(_hashable(value) for value in item))
+    return item
+
+def deep_merge_cow(source, destination):
     """
-    A simple deep merge function for dictionaries.
+    A copy-on-write deep merge function for dictionaries.
+    Returns a new dict and leaves destination untouched: only the dicts and lists along
+    the paths that source writes to are copied, all other branches are shared.
     Merges lists by extending them with unique items.
     """
+    merged = dict(destination)
     for key, value in source.items():
         if isinstance(value, dict):
-            node = destination.setdefault(key, {})
-            deep_merge(value, node)
+            node = destination.get(key)
+            merged[key] = deep_merge_cow(value, node if isinstance(node, dict) else {})
         elif isinstance(value, list):
-            if key not in destination:
-                destination[key] = []
-            destination[key].extend(item for item in value if item not in destination[key])
+            merged_list = list(destination.get(key, []))
+            seen = set(map(_hashable, merged_list))
+            for item in value:
+                h = _hashable(item)
+                if h not in seen:
+                    merged_list.append(item)
+                    seen.add(h)
+            merged[key] = merged_list
         else:
-            destination[key] = value
-    return destination
+            merged[key] = value
+    return merged
+
+def load_rails_config(colang_content, config_data):
+    """
+    Returns the RailsConfig for the given content, using the in-memory and on-disk caches when possible.
+    """
+    return _build_config(colang_content, _ConfigKey(config_data))
+
+class _ConfigKey:
+    """
+    Hashable handle on a merged config dict, so it can be passed to the lru_cache'd _build_config.
+    It compares by the dict's contents; the dict itself is passed through unchanged.
+    """
+    def __init__(self, config_data):
+        self.config_data = config_data
+        self.key = _hashable(config_data)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, _ConfigKey) and self.key == other.key
+
+@functools.lru_cache(maxsize=32)
+def _build_config(colang_content, config_key):
+    """
+    Builds the RailsConfig for a (colang, config) pair, memoized per process and pickled to disk.
+    The Python, nemoguardrails and pydantic versions are part of the disk cache key, so
+    upgrading any of them invalidates old entries.
+    """
+    key_source = "\0".join([
+        repr(sys.version_info[:2]),
+        nemoguardrails.__version__,
+        str(pydantic.VERSION),
+        colang_content,
+        repr(config_key.key),
+    ])
+    key = hashlib.sha256(key_source.encode()).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f"{key}.pkl")
+
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # A missing, truncated or incompatible entry just means rebuilding the config.
+        pass
+
+    # Pass the merged dict directly instead of dumping it to YAML only to parse it back.
+    config = RailsConfig.from_content(
+        colang_content=colang_content,
+        config=config_key.config_data
+    )
+
+    # Write to a temporary file and swap it in, so concurrent launches never read a partial pickle.
+    tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(config, f)
+        os.replace(tmp_file, cache_file)
+    except Exception:
+        # Caching is best-effort; the freshly built config is still usable.
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+    return config
+
+def create_http_client():
+    """
+    Creates the shared async HTTP client for LLM calls, using HTTP/2 when the h2 package is installed.
+    """
+    try:
+        return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    except ImportError:
+        return httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+def read_line(prompt):
+    """
+    A replacement for input() that reads from the raw stream under sys.stdin. Unlike
+    sys.stdin, it holds no lock while a read blocks, so a reader thread left waiting at
+    exit cannot stall interpreter shutdown, and reading byte by byte never consumes input
+    past the current line. Raises EOFError at end of input.
+    """
+    raw = getattr(getattr(sys.stdin, "buffer", None), "raw", None)
+    if raw is None:
+        # stdin was replaced by something without a raw stream (e.g. a test harness)
+        return input(prompt)
+    print(prompt, end="", flush=True)
+    line = raw.readline()
+    if not line:
+        raise EOFError
+    return line.decode(sys.stdin.encoding or "utf-8", errors="replace").rstrip("\r\n")
+
+async def read_input(prompt):
+    """
+    Reads a line on a daemon thread so the event loop keeps running while the user types.
+    Unlike asyncio.to_thread, the thread is not joined at shutdown, so Ctrl-C exits at once.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(line, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(line)
+
+    def read():
+        try:
+            line, error = read_line(prompt), None
+        except Exception as e:
+            line, error = None, e
+        try:
+            loop.call_soon_threadsafe(resolve, line, error)
+        except RuntimeError:
+            # The event loop already closed; nobody is waiting for this line.
+            pass
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+def with_http_client(model, http_client):
+    """
+    Returns a copy of an OpenAI model config that uses http_client; other models are returned as-is.
+    """
+    if model.engine != "openai":
+        return model
+    model = copy.copy(model)
+    model.parameters = {**model.parameters, "http_async_client": http_client}
+    return model
+
+async def warmup_llm(app, engine):
+    """
+    Sends a one-token prompt straight to the main LLM, bypassing the rails, so the model is
+    loaded (and, for remote providers, the connection is open) before the first real turn.
+    """
+    llm = getattr(app, "llm", None)
+    if llm is None:
+        return
+    # Cap the completion at one token where the provider accepts it as a call parameter
+    kwargs = {"max_tokens": 1} if engine == "openai" else {}
+    try:
+        await llm.ainvoke("ok", **kwargs)
+    except Exception:
+        # Warmup is best-effort; any real problem will surface on the first turn.
+        pass
 
 async def main():
     """
@@ -117,72 +348,117 @@ async def main():
     for key, value in GUARDRAILS_LIBRARY.items():
         print(f"  {key}: {value['name']}")
     
-    choices_str = input("\nEnter the numbers of the guardrails to activate (e.g., 1 3 5), or press Enter for none: ")
-    choices = choices_str.split()
+    choices_str = read_line("\nEnter the numbers of the guardrails to activate (e.g., 1 3 5), or press Enter for none: ")
+    # Drop unknown and repeated choices, keeping the order they were entered in
+    choices = [choice for choice in dict.fromkeys(choices_str.split()) if choice in _VALID_CHOICES]
 
     # --- Dynamically Build Configuration ---
-    with open(os.path.join(CONFIG_PATH, "config.yml"), 'r') as f:
-        config_data = yaml.safe_load(f)
-
-    colang_content = ""
-    action_modules = set()
-    selected_guardrails_names = []
-
-    for choice in choices:
-        if choice in GUARDRAILS_LIBRARY:
-            guardrail = GUARDRAILS_LIBRARY[choice]
-            selected_guardrails_names.append(guardrail['name'])
-            
-            # Merge YAML configurations
-            config_data = deep_merge(guardrail['config'], config_data)
-
-            # Append Colang content
-            colang_content += guardrail['colang'] + "\n\n"
-
-            # Track unique action modules
-            if "actions_path" in guardrail:
-                action_modules.add(guardrail['actions_path'])
-    
-    # --- Initialize LLMRails ---
-    config = RailsConfig.from_content(
-        colang_content=colang_content,
-        yaml_content=yaml.dump(config_data)
+    selected = [GUARDRAILS_LIBRARY[choice] for choice in choices]
+    selected_guardrails_names = [guardrail['name'] for guardrail in selected]
+
+    # Merge YAML configurations on top of the shared base config
+    config_data = functools.reduce(
+        lambda merged, guardrail_config: deep_merge_cow(guardrail_config, merged),
+        (guardrail['config'] for guardrail in selected),
+        _BASE_CONFIG
     )
 
-    # Load and register custom actions if any are specified
-    if action_modules:
-        for module_path in action_modules:
-            import_module(module_path)
-            # NeMo Guardrails automatically discovers actions registered with the @action decorator
+    # Join the Colang content in one pass rather than growing a string with +=
+    colang_content = "\n\n".join(guardrail['colang'] for guardrail in selected)
 
-    app = LLMRails(config)
+    # Track unique action modules
+    action_modules = {guardrail['actions_path'] for guardrail in selected if "actions_path" in guardrail}
 
-    # --- Start Interactive Chat ---
-    print("\nChain-of-Verification (CoVe) Guardrails Application")
-    print("----------------------------------------------------")
-    print(f"Using LLM provider: {LLM_PROVIDER}")
-    if selected_guardrails_names:
-        print("Active Guardrails:")
-        for name in selected_guardrails_names:
-            print(f"- {name}")
-    else:
-        print("Active Guardrails: None")
-    print("Enter 'exit' to quit the application.\n")
+    use_streaming = STREAMING and not config_data.get("rails", {}).get("output")
+    if use_streaming:
+        config_data = deep_merge_cow({"streaming": True}, config_data)
+    
+    # --- Initialize LLMRails ---
+    # Colang/YAML parsing is CPU-bound; run it on a worker thread to keep the event loop free
+    config = await asyncio.to_thread(load_rails_config, colang_content, config_data)
+
+    # Route OpenAI models through the shared HTTP client. It is set after the config is
+    # built because a live client can be neither part of the cache key nor pickled, and on
+    # copies because the built config is shared through the cache.
+    http_client = create_http_client()
+    # Cleanup also runs when setup fails or an unexpected error or Ctrl-C ends the session
+    warmup = None
+    try:
+        config = copy.copy(config)
+        config.models = [with_http_client(model, http_client) for model in config.models]
+
+        # Load and register custom actions if any are specified
+        # Imports run on the event loop thread: action modules may create asyncio primitives at
+        # import time, which on Python 3.9 fails from a worker thread without an event loop.
+        if action_modules:
+            for module_path in action_modules:
+                import_module(module_path)
+            # NeMo Guardrails automatically discovers actions registered with the @action decorator
 
-    while True:
-        try:
-            user_message = input("You: ")
+        app = LLMRails(config)
+        # Older nemoguardrails releases have no streaming API; use the buffered path there.
+        use_streaming = use_streaming and hasattr(app, "stream_async")
+
+        # Overlap model loading with the time the user spends typing the first message
+        main_engine = next((model.engine for model in config.models if model.type == "main"), None)
+        warmup = asyncio.create_task(warmup_llm(app, main_engine))
+
+        # --- Start Interactive Chat ---
+        print("\nChain-of-Verification (CoVe) Guardrails Application")
+        print("----------------------------------------------------")
+        print(f"Using LLM provider: {LLM_PROVIDER}")
+        if selected_guardrails_names:
+            print("Active Guardrails:")
+            for name in selected_guardrails_names:
+                print(f"- {name}")
+        else:
+            print("Active Guardrails: None")
+        print("Enter 'exit' to quit the application.\n")
+
+        # A single user message is reused across turns; only its content changes
+        message = {
+            "role": "user",
+            "content": ""
+        }
+        messages = [message]
+
+        while True:
+            # Read stdin without blocking the event loop, so background tasks keep running
+            try:
+                user_message = await read_input("You: ")
+            except EOFError:
+                break
             if user_message.lower() == "exit":
                 break
 
-            bot_message = await app.generate_async(messages=[{
-                "role": "user",
-                "content": user_message
-            }])
-            print(f"Bot: {bot_message['content']}")
-
-        except Exception as e:
-            print(f"An error occurred: {e}")
+            if warmup is not None:
+                try:
+                    await asyncio.wait_for(warmup, WARMUP_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+                warmup = None
+
+            message["content"] = user_message
+            try:
+                if use_streaming:
+                    print("Bot: ", end="", flush=True)
+                    async for chunk in app.stream_async(messages=messages):
+                        print(chunk, end="", flush=True)
+                    print()
+                else:
+                    bot_message = await app.generate_async(messages=messages)
+                    print(f"Bot: {bot_message['content']}")
+
+            except TURN_ERRORS as e:
+                if use_streaming:
+                    # End the partial "Bot: ..." line before reporting the error
+                    print()
+                print(f"An error occurred: {e}")
+
+    finally:
+        if warmup is not None:
+            warmup.cancel()
+        await http_client.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -202,15 +478,107 @@ colang_version: "2.x"
 
 # cove_guardrails/actions.py
 # Custom actions for the CoVe guardrail.
+import asyncio
+import hashlib
+import os
+import re
+import threading
 from nemoguardrails.actions import action
 from nemoguardrails.llm.task import LLMTask
 
-@action()
-async def self_check_facts(llm, user_message: str, bot_message: str):
+# Maximum number of LLM calls in flight at the same time, shared by all CoVe stages
+# and all concurrent conversations. Override with the COVE_MAX_CONCURRENCY env var.
+MAX_CONCURRENCY = int(os.getenv("COVE_MAX_CONCURRENCY", "5"))
+if MAX_CONCURRENCY < 1:
+    # A zero-sized semaphore would make every CoVe call wait forever
+    raise ValueError(f"COVE_MAX_CONCURRENCY must be at least 1, got {MAX_CONCURRENCY}")
+_SEM = asyncio.Semaphore(MAX_CONCURRENCY)
+
+async def _bounded(llm, prompt: str):
     """
-    This action performs the Chain-of-Verification (CoVe) process.
+    Executes a single prompt on the LLM, bounded by the module semaphore.
+    """
+    async with _SEM:
+        return await llm.execute(task=LLMTask(prompt=prompt))
+
+# Optional on-disk cache of LLM responses, keyed by the model and prompt. Enable with COVE_CACHE=1;
+# useful when re-running the same queries during development or evaluation.
+CACHE_ENABLED = os.getenv("COVE_CACHE") == "1"
+CACHE_DIR = os.getenv("COVE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nemo_veritas", "llm"))
+
+def _model_identity(llm):
+    """
+    Returns a string identifying the model behind llm, so switching models does not reuse cached answers.
+    """
+    model_name = getattr(llm, "model_name", None) or getattr(llm, "model", None)
+    return f"{type(llm).__module__}.{type(llm).__qualname__}:{model_name}"
+
+def _read_cache(path: str):
+    """
+    Returns a cached response, or None if there is no entry.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_cache(path: str, response: str):
+    """
+    Writes a cache entry atomically, so concurrent readers never see a partial file.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(response)
+    os.replace(tmp_path, path)
+
+async def _cached_execute(llm, prompt: str):
+    """
+    Executes a prompt through _bounded, serving repeated prompts from the disk cache when enabled.
+    """
+    if not CACHE_ENABLED:
+        return await _bounded(llm, prompt)
+
+    key = hashlib.sha256(f"{_model_identity(llm)}\0{prompt}".encode()).hexdigest()
+    path = os.path.join(CACHE_DIR, f"{key}.txt")
+    cached = await asyncio.to_thread(_read_cache, path)
+    if cached is not None:
+        return cached
+
+    response = await _bounded(llm, prompt)
+    if isinstance(response, str):
+        try:
+            await asyncio.to_thread(_write_cache, path, response)
+        except OSError:
+            # Caching is best-effort; a failed write must not fail the guardrail.
+            pass
+    return response
+
+# Matches one "Q: ...\nA: ..." pair in the output of the combined plan-and-verify prompt.
+# Labels may carry a list marker ("1.", "-") or markdown emphasis ("**Q:**"). An answer runs
+# over multiple lines up to the next question, or up to a blank line followed by unindented
+# text, so commentary after the last pair is not taken as part of its answer.
+_QA_PREFIX = r"^[ \t]*(?:(?:[-*+]|\d+[.)])[ \t]+)?(?:\*\*|__)?{label}(?:\*\*|__)?:(?:\*\*|__)?[ \t]*"
+_QA_RE = re.compile(
+    _QA_PREFIX.format(label="Q") + r"([^\n]+?)[ \t]*\n(?:[ \t]*\n)*"
+    + _QA_PREFIX.format(label="A") + r"(.+?)\s*"
+    + r"(?=\n" + _QA_PREFIX.format(label="Q") + r"|\n(?:[ \t]*\n)+(?=[^ \t\n])|\Z)",
+    re.M | re.S
+)
+# Matches one verification question line in the output of the plan prompt.
+_Q_RE = re.compile(r"^\s*(\?[^\n]*)", re.M)
+
+# Bot responses that are empty or open with a hedge hold no claims to verify and are
+# returned as-is without running CoVe. Short answers are still checked, since a one-line
+# answer like "The capital of Australia is Sydney." is exactly what CoVe should catch.
+_HEDGE_RE = re.compile(r"^\s*(I don['’]t know|I['’]m not sure)\b", re.I)
+
+async def _plan_and_verify_two_stage(llm, user_message: str, bot_message: str):
+    """
+    Plans the verification questions in one call, then answers each of them in its own call.
+    Returns the formatted Q&A, or None if no verification questions were generated.
     """
-    # 1. Plan Verification Questions
     plan_prompt = f"""
     Based on the following user query and bot response, generate a list of questions to verify the factual claims in the response.
 
@@ -219,18 +587,47 @@ async def self_check_facts(llm, user_message: str, bot_message: str):
 
     Verification Questions:
     """
-    verification_questions_str = await llm.execute(task=LLMTask(prompt=plan_prompt))
-    verification_questions = [q.strip() for q in verification_questions_str.split("\n") if q.strip() and q.strip().startswith("?")]
+    verification_questions_str = await _cached_execute(llm, plan_prompt)
+    verification_questions = [q.strip() for q in _Q_RE.findall(verification_questions_str)]
 
     if not verification_questions:
+        return None
+
+    # Answer the questions concurrently, since they are independent
+    answers = await asyncio.gather(*[_cached_execute(llm, q) for q in verification_questions])
+    return "\n".join(f"Q: {q}\nA: {a}" for q, a in zip(verification_questions, answers))
+
+@action()
+async def self_check_facts(llm, user_message: str, bot_message: str):
+    """
+    This action performs the Chain-of-Verification (CoVe) process.
+    """
+    # 0. Skip verification for responses without factual claims to check
+    if not bot_message.strip() or _HEDGE_RE.match(bot_message):
         return bot_message
 
-    # 2. Execute Verifications
-    verified_answers = []
-    for question in verification_questions:
-        answer = await llm.execute(task=LLMTask(prompt=question))
-        verified_answers.append(f"Q: {question}\nA: {answer}")
-    verified_answers_str = "\n".join(verified_answers)
+    # 1 + 2. Plan and Execute Verifications in a single LLM call
+    plan_and_verify_prompt = f"""
+    Based on the following user query and bot response, generate questions to verify the factual claims in the response, and answer each question independently of the bot response.
+    For each claim, output the question and its answer on consecutive lines, in the form:
+    Q: <verification question>
+    A: <answer>
+
+    User Query: "{user_message}"
+    Bot Response: "{bot_message}"
+
+    Verification Questions and Answers:
+    """
+    plan_and_verify_str = await _cached_execute(llm, plan_and_verify_prompt)
+    qa_pairs = _QA_RE.findall(plan_and_verify_str)
+
+    if qa_pairs:
+        verified_answers_str = "\n".join(f"Q: {q}\nA: {a}" for q, a in qa_pairs)
+    else:
+        # The model did not follow the Q/A format; fall back to separate plan and verify calls.
+        verified_answers_str = await _plan_and_verify_two_stage(llm, user_message, bot_message)
+        if verified_answers_str is None:
+            return bot_message
 
     # 3. Generate Final Verified Response
     final_response_prompt = f"""
@@ -244,7 +641,7 @@ async def self_check_facts(llm, user_message: str, bot_message: str):
 
     Final Verified Response:
     """
-    final_response = await llm.execute(task=LLMTask(prompt=final_response_prompt))
+    final_response = await _cached_execute(llm, final_response_prompt)
     return final_response
 
 
@@ -253,5 +650,6 @@ async def self_check_facts(llm, user_message: str, bot_message: str):
 nemoguardrails
 ollama
 openai
+httpx[http2]
 python-dotenv
 PyYAML